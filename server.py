@@ -1,18 +1,62 @@
+import asyncio
+import codecs
+import contextlib
+import functools
+import hashlib
 import json
 import mimetypes
 import os
+import re
 import shutil
 import subprocess
 import sys
+import tomllib
+import uuid
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import Any, BinaryIO
+from urllib.parse import quote
 
 from fastmcp import FastMCP
 from fastmcp.dependencies import Depends
 from fastmcp.exceptions import ToolError
 from fastmcp.server.dependencies import get_context
-from fastmcp.utilities.types import File, Image
-from mcp.types import Annotations, ImageContent, TextContent
+from mcp.types import (
+    Annotations,
+    BlobResourceContents,
+    EmbeddedResource,
+    ImageContent,
+    TextContent,
+)
+from pydantic import AnyUrl
+
+# msgspec parses and renders JSON considerably faster than the stdlib when it is installed
+try:
+    import msgspec
+
+    _json_loads = msgspec.json.decode
+
+    def _json_dumps(obj: Any) -> str:
+        return msgspec.json.encode(obj).decode()
+
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj: Any) -> str:
+        return json.dumps(obj)
+
+
+# pybase64 encodes with SIMD (SSSE3/AVX2/AVX-512/NEON) when it is installed
+try:
+    from pybase64 import b64encode as _b64encode
+    from pybase64 import b64encode_as_string as _b64encode_str
+except ImportError:
+    from base64 import b64encode as _b64encode
+
+    def _b64encode_str(data: bytes) -> str:
+        return _b64encode(data).decode("ascii")
+
 
 # Initialize FastMCP server
 mcp = FastMCP(
@@ -25,6 +69,13 @@ mcp = FastMCP(
 # Define base directory for environments
 BASE_DIR = Path.home() / ".mcp-python-executor"
 ENVS_DIR = BASE_DIR / "envs"
+# Ready-made project (base packages resolved and locked) that new environments are cloned from.
+# The leading dot keeps it out of reach of get_env_path and out of environment listings.
+TEMPLATE_DIR = ENVS_DIR / ".template"
+# File in the template recording the BASE_PACKAGES it was built from
+TEMPLATE_STAMP_FILE = ".mcp-template-stamp"
+# Deleted environments are moved here and removed in the background
+TRASH_DIR = BASE_DIR / ".trash"
 
 # Base packages to preinstall in new environments
 BASE_PACKAGES = [
@@ -37,13 +88,131 @@ BASE_PACKAGES = [
     "pillow",
 ]
 
+# Absolute path to the uv binary, resolved once so the default event loop's subprocess module
+# can use its posix_spawn fast path instead of fork+exec (under uvloop libuv spawns it instead)
+UV_BIN = shutil.which("uv") or "uv"
+
+# Environment for uv subprocesses, cleaned once to avoid leakage from the server's own virtualenv.
+# uv's cache location and link mode are left to uv and the operator: its defaults already link
+# installs from the user's (usually warm) cache, cloning on macOS and hardlinking on Linux.
+_UV_ENV = {
+    k: v for k, v in os.environ.items() if k not in ("VIRTUAL_ENV", "PYTHONPATH", "PYTHONHOME")
+}
+
+# Characters that may not appear in an environment ID (\w matches str.isalnum() plus "_")
+_UNSAFE_ID_CHARS = re.compile(r"[^\w-]")
+
+# Output kept per stream of a uv command; anything beyond is drained and dropped
+MAX_OUTPUT_SIZE = 10 * 1024 * 1024
+
+# Read size when base64-encoding files; a multiple of 3 so chunks encode without padding
+B64_CHUNK_SIZE = 768 * 1024
+
+# Image/binary files at least this large keep their base64 encoding cached for repeat reads
+B64_CACHE_MIN_SIZE = 512 * 1024
+
+# MIME types for the extensions read most often, checked before the mimetypes database
+_FAST_MIME = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+    ".svg": "image/svg+xml",
+    ".pdf": "application/pdf",
+    ".csv": "text/csv",
+    ".json": "application/json",
+    ".txt": "text/plain",
+    ".md": "text/markdown",
+    ".html": "text/html",
+    ".py": "text/x-python",
+}
+
+# Leading bytes of image formats that are recognized by content, whatever the file extension
+_IMAGE_MAGIC = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+)
+
+# Load the mimetypes database now rather than on the first read_file call
+mimetypes.init()
+
+
+def _latin1_fallback(exc: UnicodeError) -> tuple[str, int]:
+    """Decode error handler that maps undecodable bytes to their latin-1 characters."""
+    if not isinstance(exc, UnicodeDecodeError):
+        raise exc
+    return exc.object[exc.start : exc.end].decode("latin-1"), exc.end
+
+
+codecs.register_error("latin1fallback", _latin1_fallback)
+
+# Package specs that are a bare project name, with no version, extras or URL
+_BARE_REQUIREMENT = re.compile(r"\A[A-Za-z0-9][A-Za-z0-9._-]*\Z")
+# Leading project name of a PEP 508 requirement string
+_REQUIREMENT_NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+# Runs of separators that PEP 503 normalization collapses to a single "-"
+_NAME_SEPARATORS = re.compile(r"[-_.]+")
+
+# Directories never descended into when listing environment files
+_SKIP_DIRS = frozenset({".venv", ".git", "__pycache__"})
+
+# Window during which concurrent add/remove requests for one environment are
+# merged into a single uv invocation
+PACKAGE_BATCH_WINDOW = 0.025
+
+# Pending package requests keyed by (environment path, uv subcommand)
+_PACKAGE_BATCHES: dict[tuple[Path, str], list[tuple[list[str], asyncio.Future]]] = {}
+# Serializes uv operations that mutate an environment's dependencies
+_ENV_LOCKS: dict[Path, asyncio.Lock] = {}
+# Environments known to exist in this process, so repeat lookups skip the filesystem
+_ENV_PATHS: dict[str, Path] = {}
+# Resolved (symlink-free) form of each environment root
+_RESOLVED_ROOTS: dict[Path, Path] = {}
+# Shared worker threads for blocking filesystem work, so no call spawns its own thread
+_IO_POOL = ThreadPoolExecutor(
+    max_workers=min(32, (os.cpu_count() or 1) * 4), thread_name_prefix="mcp-io"
+)
+# Bounds how many environments are queried at once by multi-environment listings
+_ENV_QUERY_SEMAPHORE = asyncio.Semaphore(min(8, (os.cpu_count() or 1) * 2))
+# Serializes building the template environment
+_TEMPLATE_LOCK = asyncio.Lock()
+# Bumped whenever this process creates or deletes an environment
+_ENVS_GENERATION = 0
+# Rendered envs://list resource and the (generation, ENVS_DIR mtime) it was rendered at
+_LIST_ENVS_CACHE: tuple[tuple[int, int], str] | None = None
+# Project file mtimes of each environment as of its last successful `uv run`
+_SYNC_STAMPS: dict[Path, tuple[int, ...]] = {}
+# Strong references to fire-and-forget tasks so they are not garbage collected
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+
 # Ensure directories exist
 ENVS_DIR.mkdir(parents=True, exist_ok=True)
+TRASH_DIR.mkdir(exist_ok=True)
+
+# Environments left by earlier runs are known up front, so their first use skips the stat
+with os.scandir(ENVS_DIR) as _entries:
+    _ENV_PATHS.update(
+        (e.name, ENVS_DIR / e.name) for e in _entries if not e.name.startswith(".") and e.is_dir()
+    )
+
+# Finish deletions cut short by an earlier shutdown
+with os.scandir(TRASH_DIR) as _entries:
+    for _entry in _entries:
+        _IO_POOL.submit(shutil.rmtree, _entry.path, ignore_errors=True)
 
 
+async def _run_io(func: Callable[..., Any], /, *args: Any, **kwargs: Any) -> Any:
+    """Run blocking filesystem work on _IO_POOL without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_IO_POOL, functools.partial(func, *args, **kwargs))
+
+
+@functools.lru_cache(maxsize=256)
 def get_env_path(env_id: str) -> Path:
     """Get the absolute path for a specific environment."""
-    safe_id = "".join(c for c in env_id if c.isalnum() or c in ("-", "_")).strip()
+    safe_id = _UNSAFE_ID_CHARS.sub("", env_id)
     if not safe_id:
         raise ValueError(f"Invalid environment ID: {env_id}")
     return ENVS_DIR / safe_id
@@ -51,90 +220,359 @@ def get_env_path(env_id: str) -> Path:
 
 def get_safe_file_path(env_path: Path, filename: str) -> Path:
     """Get a safe absolute path for a file within an environment."""
-    # Prevent path traversal
+    # The environment root never moves, so it is resolved only once
+    env_root = _RESOLVED_ROOTS.get(env_path)
+    if env_root is None:
+        env_root = _RESOLVED_ROOTS[env_path] = env_path.resolve()
+
+    # Prevent path traversal (resolving also follows symlinks that point outside)
     requested_path = (env_path / filename).resolve()
-    if not str(requested_path).startswith(str(env_path.resolve())):
+    if not requested_path.is_relative_to(env_root):
         raise ValueError(f"Illegal filename: {filename}")
     return requested_path
 
 
-def run_uv_command(args: list[str], cwd: Path | None = None) -> subprocess.CompletedProcess:
-    """Run a uv command and return the result."""
-    # Clean environment to avoid leakage from the server's own virtualenv
-    env = os.environ.copy()
-    env.pop("VIRTUAL_ENV", None)
-    env.pop("PYTHONPATH", None)
-    env.pop("PYTHONHOME", None)
+async def _read_capped(stream: asyncio.StreamReader) -> bytes:
+    """Read a stream to EOF, keeping at most MAX_OUTPUT_SIZE bytes of it."""
+    buf = bytearray()
+    dropped = 0
+    while chunk := await stream.read(64 * 1024):
+        room = MAX_OUTPUT_SIZE - len(buf)
+        if len(chunk) <= room:
+            buf += chunk
+        else:
+            buf += chunk[:room]
+            dropped += len(chunk) - room
+    if dropped:
+        buf += f"\n[output truncated: {dropped} more bytes]".encode()
+    return bytes(buf)
+
+
+async def _communicate(proc: asyncio.subprocess.Process) -> tuple[int, bytes, bytes]:
+    """Like Process.communicate(), but with memory bounded by MAX_OUTPUT_SIZE per stream.
+
+    Returns the exit code along with the captured stdout and stderr.
+    """
+    # Both streams are created with PIPE by run_uv_command
+    assert proc.stdout is not None and proc.stderr is not None
+    stdout, stderr = await asyncio.gather(_read_capped(proc.stdout), _read_capped(proc.stderr))
+    returncode = await proc.wait()
+    return returncode, stdout, stderr
+
+
+async def run_uv_command(args: list[str], cwd: Path | None = None) -> subprocess.CompletedProcess:
+    """Run a uv command without blocking the event loop and return the result."""
+    # posix_spawn is only eligible without a cwd, so let uv change directory itself.
+    # uvloop spawns through libuv regardless, where this is merely equivalent to cwd=.
+    global_args = ["--directory", str(cwd)] if cwd is not None else []
+    # Reported as the command in every result, whatever the outcome
+    cmd = ["uv"] + args
 
     try:
-        # Ensure uv is in the path
-        result = subprocess.run(
-            ["uv"] + args,
-            cwd=cwd,
-            env=env,
-            capture_output=True,
-            text=True,
-            timeout=300,
+        proc = await asyncio.create_subprocess_exec(
+            UV_BIN,
+            *global_args,
+            *args,
+            env=_UV_ENV,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
         )
-        return result
-    except subprocess.TimeoutExpired:
+        try:
+            returncode, stdout, stderr = await asyncio.wait_for(_communicate(proc), timeout=300)
+        except TimeoutError:
+            with contextlib.suppress(ProcessLookupError):
+                proc.kill()
+            await proc.wait()
+            return subprocess.CompletedProcess(
+                args=cmd,
+                returncode=1,
+                stdout="",
+                stderr="Error: Command timed out after 300 seconds.",
+            )
+        except BaseException:
+            # Cancelled mid-run: kill and reap the child rather than leave it blocked on
+            # pipes nobody reads any more
+            with contextlib.suppress(ProcessLookupError):
+                proc.kill()
+            await proc.wait()
+            raise
         return subprocess.CompletedProcess(
-            args=args,
-            returncode=1,
-            stdout="",
-            stderr="Error: Command timed out after 300 seconds.",
+            args=cmd,
+            returncode=returncode,
+            # One decode per stream; stray non-UTF-8 bytes from user code must not discard output
+            stdout=stdout.decode("utf-8", errors="replace"),
+            stderr=stderr.decode("utf-8", errors="replace"),
         )
     except Exception as e:
         return subprocess.CompletedProcess(
-            args=args, returncode=1, stdout="", stderr=f"Error: {str(e)}"
+            args=cmd, returncode=1, stdout="", stderr=f"Error: {str(e)}"
         )
 
 
-def _ensure_env(env_id: str) -> Path:
+def _env_lock(env_path: Path) -> asyncio.Lock:
+    """Get the lock guarding creation of and dependency changes to an environment."""
+    return _ENV_LOCKS.setdefault(env_path, asyncio.Lock())
+
+
+def _canonical_name(name: str) -> str:
+    """Normalize a project name per PEP 503."""
+    return _NAME_SEPARATORS.sub("-", name).lower()
+
+
+@functools.lru_cache(maxsize=64)
+def _load_direct_dependencies(pyproject_path: Path, mtime_ns: int) -> frozenset[str]:
+    """Canonical names of a project's dependencies (cached per file modification time)."""
+    with pyproject_path.open("rb") as f:
+        project = tomllib.load(f).get("project", {})
+    return frozenset(
+        _canonical_name(match.group())
+        for requirement in project.get("dependencies", [])
+        if (match := _REQUIREMENT_NAME.match(requirement.strip()))
+    )
+
+
+def _missing_dependencies(env_path: Path, packages: list[str]) -> list[str]:
+    """Drop bare package names that are already direct dependencies of the environment."""
+    pyproject_path = env_path / "pyproject.toml"
+    try:
+        present = _load_direct_dependencies(pyproject_path, pyproject_path.stat().st_mtime_ns)
+    # ValueError covers both TOMLDecodeError and a file that is not valid UTF-8
+    except OSError, ValueError, AttributeError, TypeError:
+        return packages
+    return [
+        p for p in packages if not (_BARE_REQUIREMENT.match(p) and _canonical_name(p) in present)
+    ]
+
+
+async def run_uv_package_command(
+    command: str, packages: list[str], cwd: Path
+) -> subprocess.CompletedProcess:
+    """Run `uv add`/`uv remove`, coalescing concurrent requests for the same environment."""
+    key = (cwd, command)
+    future = asyncio.get_running_loop().create_future()
+    batch = _PACKAGE_BATCHES.get(key)
+    if batch is None:
+        batch = _PACKAGE_BATCHES[key] = []
+        task = asyncio.create_task(_flush_package_batch(key))
+        _BACKGROUND_TASKS.add(task)
+        task.add_done_callback(_BACKGROUND_TASKS.discard)
+    batch.append((packages, future))
+    return await future
+
+
+async def _flush_package_batch(key: tuple[Path, str]) -> None:
+    cwd, command = key
+    await asyncio.sleep(PACKAGE_BATCH_WINDOW)
+    # Requests arriving from here on start the next batch
+    batch = _PACKAGE_BATCHES.pop(key)
+    packages = list(dict.fromkeys(p for requested, _ in batch for p in requested))
+    try:
+        async with _env_lock(cwd):
+            if command == "add":
+                packages = _missing_dependencies(cwd, packages)
+            if packages:
+                result = await run_uv_command([command] + packages, cwd=cwd)
+            else:
+                # Everything requested is already a dependency; uv would only re-resolve
+                result = subprocess.CompletedProcess(["uv", command], 0, "", "")
+    except Exception as e:
+        # Every request in the batch fails with the error of the shared invocation
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+    else:
+        for _, future in batch:
+            if not future.done():
+                future.set_result(result)
+    finally:
+        # Futures are only still pending here if the flush itself was cancelled
+        for _, future in batch:
+            future.cancel()
+
+
+def _template_stamp() -> str:
+    """Fingerprint of the template's inputs; a template with another stamp is rebuilt."""
+    return hashlib.sha256("\n".join(BASE_PACKAGES).encode()).hexdigest()
+
+
+def _template_is_current() -> bool:
+    """Whether TEMPLATE_DIR exists and was built from the current BASE_PACKAGES."""
+    try:
+        return (TEMPLATE_DIR / TEMPLATE_STAMP_FILE).read_text() == _template_stamp()
+    except OSError:
+        return False
+
+
+def _sweep_template_staging() -> None:
+    """Remove staging directories left behind by template builds of dead processes."""
+    if sys.platform == "win32":
+        # os.kill cannot probe a process there without terminating it
+        return
+    for staging in TEMPLATE_DIR.parent.glob(f"{TEMPLATE_DIR.name}-*"):
+        pid = staging.name.rpartition("-")[2]
+        if not pid.isdigit():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            shutil.rmtree(staging, ignore_errors=True)
+        except OSError:
+            # Alive, but owned by someone else
+            pass
+
+
+async def _ensure_template() -> bool:
+    """Build the template project if needed. Returns False if it could not be built."""
+    async with _TEMPLATE_LOCK:
+        if _template_is_current():
+            return True
+
+        await _run_io(_sweep_template_staging)
+        # Build under a scratch name and rename, so a half-built template is never cloned.
+        # The template holds only project files; each clone syncs its own venv.
+        staging = TEMPLATE_DIR.with_name(f"{TEMPLATE_DIR.name}-{os.getpid()}")
+        await _run_io(shutil.rmtree, staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        for args in (
+            ["init", "--lib", "--name", "mcp-env"],
+            ["add", "--no-sync"] + BASE_PACKAGES,
+        ):
+            res = await run_uv_command(args, cwd=staging)
+            if res.returncode != 0:
+                print(
+                    f"Warning: Failed to build template environment:\n{res.stderr}",
+                    file=sys.stderr,
+                )
+                await _run_io(shutil.rmtree, staging, ignore_errors=True)
+                return False
+        (staging / TEMPLATE_STAMP_FILE).write_text(_template_stamp())
+
+        if TEMPLATE_DIR.exists() and not _template_is_current():
+            # Outdated: retire it to the trash rather than deleting it in place
+            retired = TRASH_DIR / f"{TEMPLATE_DIR.name}-{uuid.uuid4().hex}"
+            with contextlib.suppress(OSError):
+                TEMPLATE_DIR.rename(retired)
+                _IO_POOL.submit(shutil.rmtree, retired, ignore_errors=True)
+        try:
+            staging.rename(TEMPLATE_DIR)
+        except OSError:
+            # Another server process sharing BASE_DIR installed its template first
+            await _run_io(shutil.rmtree, staging, ignore_errors=True)
+            return _template_is_current()
+        return True
+
+
+async def _clone_template(env_id: str, env_path: Path) -> None:
+    """Create an environment from the template's project files and sync its venv."""
+    await _run_io(
+        shutil.copytree,
+        TEMPLATE_DIR,
+        env_path,
+        symlinks=True,
+        ignore=shutil.ignore_patterns(".venv", TEMPLATE_STAMP_FILE),
+    )
+    # The lockfile is already resolved, so this only installs, hardlinking from uv's cache
+    res = await run_uv_command(["sync", "--frozen"], cwd=env_path)
+    if res.returncode != 0:
+        # Log warning but don't fail - environment is still usable
+        print(
+            f"Warning: Failed to install base packages in environment {env_id}:\n{res.stderr}",
+            file=sys.stderr,
+        )
+
+
+def _remove_dir(path: Path) -> None:
+    """Remove a directory, trying a single rmdir before walking it with rmtree."""
+    try:
+        path.rmdir()
+    except OSError:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+async def _init_env(env_id: str, env_path: Path) -> None:
+    """Initialize an environment from scratch with uv."""
+    env_path.mkdir(parents=True, exist_ok=True)
+    init_res = await run_uv_command(["init", "--lib"], cwd=env_path)
+    if init_res.returncode != 0:
+        # Cleanup on failure; a failed init usually leaves the directory empty
+        await _run_io(_remove_dir, env_path)
+        raise ToolError(f"Failed to initialize environment {env_id}:\n{init_res.stderr}")
+    # Install base packages
+    add_res = await run_uv_command(["add"] + BASE_PACKAGES, cwd=env_path)
+    if add_res.returncode != 0:
+        # Log warning but don't fail - environment is still usable
+        print(
+            f"Warning: Failed to install base packages in environment {env_id}:\n{add_res.stderr}",
+            file=sys.stderr,
+        )
+
+
+async def _ensure_env(env_id: str) -> Path:
     """Ensure an environment exists, initializing it if necessary."""
+    global _ENVS_GENERATION
+
+    env_path = _ENV_PATHS.get(env_id)
+    if env_path is not None:
+        return env_path
+
     env_path = get_env_path(env_id)
-    if not env_path.exists():
-        env_path.mkdir(parents=True, exist_ok=True)
-        init_res = run_uv_command(["init", "--lib"], cwd=env_path)
-        if init_res.returncode != 0:
-            # Cleanup on failure
-            shutil.rmtree(env_path)
-            raise ToolError(f"Failed to initialize environment {env_id}:\n{init_res.stderr}")
-        # Install base packages
-        add_res = run_uv_command(["add"] + BASE_PACKAGES, cwd=env_path)
-        if add_res.returncode != 0:
-            # Log warning but don't fail - environment is still usable
-            print(
-                f"Warning: Failed to install base packages in environment {env_id}:"
-                f"\n{add_res.stderr}",
-                file=sys.stderr,
-            )
+    # Concurrent first calls for the same environment must not both create it
+    async with _env_lock(env_path):
+        if not env_path.exists():
+            if await _ensure_template():
+                try:
+                    await _clone_template(env_id, env_path)
+                except Exception as e:
+                    await _run_io(_remove_dir, env_path)
+                    raise ToolError(f"Failed to initialize environment {env_id}:\n{e}")
+            else:
+                await _init_env(env_id, env_path)
+            _ENVS_GENERATION += 1
+    _ENV_PATHS[env_id] = env_path
     return env_path
 
 
-def _execute_python(
+def _sync_stamp(env_path: Path) -> tuple[int, ...] | None:
+    """Modification times of the files `uv sync` depends on, or None if any is missing."""
+    try:
+        return tuple(
+            os.stat(env_path / name).st_mtime_ns
+            for name in ("pyproject.toml", "uv.lock", ".venv/pyvenv.cfg")
+        )
+    except OSError:
+        return None
+
+
+async def _execute_python(
     env_id: str,
     code: str | None = None,
     filename: str = "main.py",
     packages: list[str] | None = None,
 ) -> dict[str, Any]:
-    env_path = _ensure_env(env_id)
+    env_path = await _ensure_env(env_id)
 
     if packages:
-        add_res = run_uv_command(["add"] + packages, cwd=env_path)
+        add_res = await run_uv_package_command("add", packages, cwd=env_path)
         if add_res.returncode != 0:
             raise ToolError(f"Failed to add packages to environment {env_id}:\n{add_res.stderr}")
 
     file_path = get_safe_file_path(env_path, filename)
 
     if code:
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-        file_path.write_text(code)
-
-    if not file_path.exists():
+        await _write_env_file(env_id, env_path, file_path, code.encode("utf-8"))
+    elif not file_path.exists():
         raise FileNotFoundError(f"File '{filename}' not found in environment '{env_id}'.")
 
-    run_res = run_uv_command(["run", str(file_path)], cwd=env_path)
+    # uv run re-checks the lockfile and venv each time; skip that when nothing changed since
+    # the last successful run
+    stamp = _sync_stamp(env_path)
+    run_args = ["run", str(file_path)]
+    if stamp is not None and _SYNC_STAMPS.get(env_path) == stamp:
+        run_args.insert(1, "--no-sync")
+    run_res = await run_uv_command(run_args, cwd=env_path)
+    if run_res.returncode == 0:
+        if (stamp := _sync_stamp(env_path)) is not None:
+            _SYNC_STAMPS[env_path] = stamp
 
     output_data = {
         "stdout": run_res.stdout,
@@ -148,141 +586,360 @@ def _execute_python(
     return output_data
 
 
-def _write_file(env_id: str, filename: str, content: str) -> dict[str, Any]:
-    env_path = _ensure_env(env_id)
+def _write_bytes(file_path: Path, data: bytes, root: Path) -> None:
+    """Atomically replace a file's contents using raw os.write calls on a temporary file.
+
+    Missing parent directories below root are created; a missing root is not.
+    """
+    # Readers never see a partially written file, even if the server dies mid-write
+    tmp_path = file_path.with_name(f".{file_path.name}.{uuid.uuid4().hex}.tmp")
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    try:
+        fd = os.open(tmp_path, flags, 0o666)
+    except FileNotFoundError:
+        # Parent directories are only created once a write shows they are missing
+        if not root.is_dir():
+            raise
+        tmp_path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(tmp_path, flags, 0o666)
+    try:
+        try:
+            # The replacement is a new inode, so carry over the mode of the file it replaces
+            with contextlib.suppress(FileNotFoundError):
+                os.fchmod(fd, os.stat(file_path).st_mode & 0o7777)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view) :]
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+async def _write_env_file(env_id: str, env_path: Path, file_path: Path, data: bytes) -> None:
+    """Write a file into an environment, recreating the environment if it was deleted on disk."""
+    try:
+        await _run_io(_write_bytes, file_path, data, env_path)
+    except FileNotFoundError:
+        if env_path.is_dir():
+            raise
+        # Removed behind the server's back (the cache still vouched for it), so initialize it
+        # again rather than leave a bare directory that uv would not treat as a project
+        _forget_env(env_path)
+        await _ensure_env(env_id)
+        await _run_io(_write_bytes, file_path, data, env_path)
+
+
+async def _write_file(env_id: str, filename: str, content: str) -> dict[str, Any]:
+    env_path = await _ensure_env(env_id)
 
     try:
         file_path = get_safe_file_path(env_path, filename)
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-        file_path.write_text(content)
+        data = content.encode("utf-8")
+        await _write_env_file(env_id, env_path, file_path, data)
+        # Timestamps can be coarser than back-to-back writes, so don't trust the cache key
+        _b64encode_cached.cache_clear()
         return {
             "status": "success",
             "filename": filename,
-            "bytes_written": len(content),
+            "bytes_written": len(data),
         }
     except Exception as e:
         raise ToolError(f"Error writing file: {str(e)}")
 
 
-def _read_file(env_id: str, filename: str, annotations: Annotations):
-    env_path = _ensure_env(env_id)
+def _b64encode_file(f: BinaryIO) -> str:
+    """Base64-encode the rest of an open file without holding the raw bytes in memory."""
+    encoded = bytearray()
+    while chunk := f.read(B64_CHUNK_SIZE):
+        encoded += _b64encode(chunk)
+    return encoded.decode("ascii")
 
-    try:
-        file_path = get_safe_file_path(env_path, filename)
-        if not file_path.exists():
-            raise FileNotFoundError(f"File '{filename}' not found.")
-
-        # Check file size (limit to 10MB)
-        file_size = file_path.stat().st_size
-        if file_size > 10 * 1024 * 1024:
-            raise ToolError(
-                f"File '{filename}' is too large ({file_size} bytes). Max size is 10MB."
-            )
 
-        mime_type, _ = mimetypes.guess_type(file_path)
-        data = file_path.read_bytes()
+# Only the latest file is kept: an encoding is 4/3 the size of its file, so a deeper cache
+# would pin several large files' worth of memory for the life of the server
+@functools.lru_cache(maxsize=1)
+def _b64encode_cached(file_path: Path, mtime_ns: int, size: int) -> str:
+    """Base64-encode a file, cached per file version so repeated reads skip the encode."""
+    with file_path.open("rb") as f:
+        return _b64encode_file(f)
+
+
+def _sniff_image(head: bytes) -> str | None:
+    """Return the image MIME type indicated by a file's leading bytes, if any."""
+    for magic, mime_type in _IMAGE_MAGIC:
+        if head.startswith(magic):
+            return mime_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
 
-        # Detection logic
-        is_image = mime_type and mime_type.startswith("image/")
 
-        # Binary check: look for null byte in first 1024 bytes
-        is_binary = False
-        if not is_image:
-            chunk = data[:1024]
-            if b"\0" in chunk:
-                is_binary = True
+def _read_whole(f: BinaryIO, head: bytes) -> bytes:
+    """Return the full contents of an unbuffered file whose first 1024 bytes were read as head."""
+    if len(head) < 1024:
+        # A short read means the head already is the whole file
+        return head
+    # One fstat-sized read from the start instead of building head + rest as a second copy
+    f.seek(0)
+    return f.read()
 
-        if is_image:
-            return Image(data=data, format=mime_type or "image/png", annotations=annotations)
 
-        if is_binary:
-            return File(
-                data=data, format=mime_type or "application/octet-stream", annotations=annotations
+def _load_file(
+    env_path: Path, filename: str, annotations: Annotations
+) -> TextContent | ImageContent | EmbeddedResource:
+    """Read a file from an environment into an MCP content block. Blocking."""
+    file_path = get_safe_file_path(env_path, filename)
+    try:
+        stat = file_path.stat()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"File '{filename}' not found.") from None
+
+    # Check file size (limit to 10MB)
+    file_size = stat.st_size
+    if file_size > 10 * 1024 * 1024:
+        raise ToolError(f"File '{filename}' is too large ({file_size} bytes). Max size is 10MB.")
+
+    # Unbuffered: each read is a single syscall and the rest-of-file read is sized via fstat
+    with open(file_path, "rb", buffering=0) as f:
+        # Classify from the first 1024 bytes before reading the rest
+        head = f.read(1024)
+
+        # Detection logic: magic bytes first, then the file extension
+        mime_type = (
+            _sniff_image(head)
+            or _FAST_MIME.get(file_path.suffix.lower())
+            or mimetypes.guess_type(file_path)[0]
+        )
+        is_image = mime_type and mime_type.startswith("image/")
+
+        # Binary check: look for null byte in first 1024 bytes (bytes.find is a memchr scan)
+        is_binary = not is_image and head.find(b"\0") != -1
+
+        if is_image or is_binary:
+            if file_size >= B64_CACHE_MIN_SIZE:
+                encoded = _b64encode_cached(file_path, stat.st_mtime_ns, file_size)
+            else:
+                encoded = _b64encode_str(_read_whole(f, head))
+
+            if is_image:
+                # is_image implies a MIME type was found
+                assert mime_type is not None
+                return ImageContent(
+                    type="image",
+                    data=encoded,
+                    mimeType=mime_type,
+                    annotations=annotations,
+                )
+
+            return EmbeddedResource(
+                type="resource",
+                resource=BlobResourceContents(
+                    blob=encoded,
+                    mimeType=mime_type or "application/octet-stream",
+                    uri=AnyUrl(f"file:///{quote(file_path.name)}"),
+                ),
+                annotations=annotations,
             )
 
-        # Assume text
-        try:
-            content = data.decode("utf-8")
-        except UnicodeDecodeError:
-            content = data.decode("latin-1")
+        data = _read_whole(f, head)
+
+    # Assume text; invalid UTF-8 falls back to latin-1 byte by byte, in the same pass
+    content = data.decode("utf-8", errors="latin1fallback")
+
+    return TextContent(type="text", text=content, annotations=annotations)
 
-        return TextContent(type="text", text=content, annotations=annotations)
 
+async def _read_file(env_id: str, filename: str, annotations: Annotations):
+    env_path = await _ensure_env(env_id)
+
+    try:
+        # File I/O runs on a worker thread so large reads don't stall the event loop
+        return await _run_io(_load_file, env_path, filename, annotations)
     except Exception as e:
         raise ToolError(f"Error reading file: {str(e)}")
 
 
-def _list_files(env_id: str) -> dict[str, Any]:
-    env_path = _ensure_env(env_id)
+def _collect_files(env_path: Path) -> list[str]:
+    """List files relative to env_path, pruning _SKIP_DIRS before descending. Blocking."""
+    root = os.fspath(env_path)
+    # Every walked directory below root starts with root + os.sep
+    prefix_len = len(root) + len(os.sep)
+    files: list[str] = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        # Pruning in place keeps os.walk from descending into skipped directories
+        dirnames[:] = [d for d in dirnames if d not in _SKIP_DIRS]
+        if rel := dirpath[prefix_len:]:
+            files.extend(rel + os.sep + f for f in filenames)
+        else:
+            files.extend(filenames)
+    return files
 
-    files = []
-    for p in env_path.rglob("*"):
-        if ".venv" in p.parts or ".git" in p.parts:
-            continue
-        if p.is_file():
-            files.append(str(p.relative_to(env_path)))
+
+async def _list_files(env_id: str) -> dict[str, Any]:
+    env_path = await _ensure_env(env_id)
+
+    files = await _run_io(_collect_files, env_path)
 
     # Sort by number of path components, then by path string
-    files.sort(key=lambda p: (len(Path(p).parts), p))
+    files.sort(key=lambda p: (p.count(os.sep), p))
     return {"env_id": env_id, "files": files}
 
 
-def _install_packages(env_id: str, packages: list[str]) -> dict[str, Any]:
-    env_path = _ensure_env(env_id)
+async def _install_packages(env_id: str, packages: list[str]) -> dict[str, Any]:
+    env_path = await _ensure_env(env_id)
 
-    res = run_uv_command(["add"] + packages, cwd=env_path)
+    res = await run_uv_package_command("add", packages, cwd=env_path)
     if res.returncode == 0:
         return {"status": "success", "env_id": env_id, "installed": packages}
     else:
         raise ToolError(f"Error installing packages:\n{res.stderr}")
 
 
-def _remove_packages(env_id: str, packages: list[str]) -> dict[str, Any]:
-    env_path = _ensure_env(env_id)
+async def _remove_packages(env_id: str, packages: list[str]) -> dict[str, Any]:
+    env_path = await _ensure_env(env_id)
 
-    res = run_uv_command(["remove"] + packages, cwd=env_path)
+    res = await run_uv_package_command("remove", packages, cwd=env_path)
     if res.returncode == 0:
         return {"status": "success", "env_id": env_id, "removed": packages}
     else:
         raise ToolError(f"Error removing packages:\n{res.stderr}")
 
 
-def _list_packages(env_id: str) -> dict[str, Any]:
-    env_path = _ensure_env(env_id)
+@functools.lru_cache(maxsize=64)
+def _load_locked_packages(lock_path: Path, mtime_ns: int) -> list[dict[str, str]]:
+    """Parse the packages pinned in a uv.lock file (cached per file modification time)."""
+    with lock_path.open("rb") as f:
+        lock = tomllib.load(f)
+    return [
+        {"name": pkg["name"], "version": pkg.get("version", "")} for pkg in lock.get("package", [])
+    ]
+
+
+def _installed_dists(venv_path: Path) -> set[str] | None:
+    """Canonical names of the distributions installed in a virtualenv, or None if it has none."""
+    for site_packages in (
+        *venv_path.glob("lib/python*/site-packages"),
+        venv_path / "Lib/site-packages",
+    ):
+        try:
+            with os.scandir(site_packages) as it:
+                return {
+                    _canonical_name(e.name.removesuffix(".dist-info").rpartition("-")[0])
+                    for e in it
+                    if e.name.endswith(".dist-info")
+                }
+        except FileNotFoundError:
+            continue
+    return None
+
+
+async def _list_packages(env_id: str) -> dict[str, Any]:
+    env_path = await _ensure_env(env_id)
+
+    # uv rewrites the lockfile on every add/remove, so it is the cheapest source of truth. It is
+    # resolved for every platform, though, so keep only what was actually installed here.
+    lock_path = env_path / "uv.lock"
+    try:
+        installed = _installed_dists(env_path / ".venv")
+        if installed is not None:
+            packages = _load_locked_packages(lock_path, lock_path.stat().st_mtime_ns)
+            packages = [p for p in packages if _canonical_name(p["name"]) in installed]
+            return {"env_id": env_id, "packages": packages}
+    # ValueError covers both TOMLDecodeError and a file that is not valid UTF-8
+    except OSError, ValueError, KeyError, TypeError:
+        pass
 
-    res = run_uv_command(["pip", "list", "--format", "json"], cwd=env_path)
+    res = await run_uv_command(["pip", "list", "--format", "json"], cwd=env_path)
     if res.returncode == 0:
         try:
-            packages = json.loads(res.stdout)
+            packages = _json_loads(res.stdout)
             return {"env_id": env_id, "packages": packages}
-        except json.JSONDecodeError:
+        except ValueError:
             raise ToolError("Failed to parse package list from uv.")
     else:
         raise ToolError(f"Error listing packages:\n{res.stderr}")
 
 
 def _list_envs() -> dict[str, Any]:
-    if not ENVS_DIR.exists():
+    # DirEntry.is_dir() answers from the directory listing, with no per-entry stat
+    try:
+        with os.scandir(ENVS_DIR) as it:
+            envs = [e.name for e in it if not e.name.startswith(".") and e.is_dir()]
+    except FileNotFoundError:
         return {"environments": []}
-
-    envs = [d.name for d in ENVS_DIR.iterdir() if d.is_dir()]
     return {"environments": sorted(envs)}
 
 
+async def _list_envs_detailed() -> dict[str, Any]:
+    """List all environments together with their packages, querying them concurrently."""
+
+    async def describe(env_id: str) -> dict[str, Any]:
+        async with _ENV_QUERY_SEMAPHORE:
+            try:
+                return await _list_packages(env_id)
+            except Exception as e:
+                return {"env_id": env_id, "error": str(e)}
+
+    envs = _list_envs()["environments"]
+    return {"environments": await asyncio.gather(*(describe(env_id) for env_id in envs))}
+
+
+def _forget_env(env_path: Path) -> None:
+    """Drop everything cached about an environment."""
+    # Forget every ID that sanitizes to this environment
+    for known_id in [k for k, p in _ENV_PATHS.items() if p == env_path]:
+        del _ENV_PATHS[known_id]
+    _RESOLVED_ROOTS.pop(env_path, None)
+    _SYNC_STAMPS.pop(env_path, None)
+
+
 def _delete_env(env_id: str) -> dict[str, Any]:
+    global _ENVS_GENERATION
+
     env_path = get_env_path(env_id)
     if env_path.exists() and env_path.is_dir():
-        shutil.rmtree(env_path)
+        _forget_env(env_path)
+        _ENVS_GENERATION += 1
+        # Renaming is atomic and frees the ID at once; the slow recursive delete runs in
+        # the background
+        tombstone = TRASH_DIR / f"{env_path.name}-{uuid.uuid4().hex}"
+        env_path.rename(tombstone)
+        _IO_POOL.submit(shutil.rmtree, tombstone, ignore_errors=True)
         return {"status": "deleted", "env_id": env_id}
     else:
         raise ValueError(f"Environment '{env_id}' not found.")
 
 
+def _render_envs_list() -> str:
+    """Render the environment listing as JSON, reusing the last rendering while it is current."""
+    global _LIST_ENVS_CACHE
+
+    # Changes made by this server bump the generation; the directory's mtime catches those made
+    # outside it, though it can be too coarse to tell back-to-back changes apart
+    key = (_ENVS_GENERATION, ENVS_DIR.stat().st_mtime_ns)
+    if _LIST_ENVS_CACHE is not None and _LIST_ENVS_CACHE[0] == key:
+        return _LIST_ENVS_CACHE[1]
+
+    envs = _list_envs()
+    rendered = _json_dumps(envs)
+    _LIST_ENVS_CACHE = (key, rendered)
+    return rendered
+
+
 @mcp.resource("envs://list")
 def list_envs_resource() -> str:
     """List all available persistent environments."""
-    envs = _list_envs()
-    return json.dumps(envs, indent=2)
+    return _render_envs_list()
+
+
+@mcp.resource("envs://list/detailed")
+async def list_envs_detailed_resource() -> str:
+    """List all available persistent environments with their installed packages."""
+    envs = await _list_envs_detailed()
+    return _json_dumps(envs)
 
 
 def get_session_id() -> str:
@@ -297,12 +954,18 @@ def get_session_id() -> str:
     if not session_id:
         raise ToolError("Session ID not found")
 
+    # Reject IDs that cannot name an environment before any tool work or filesystem access
+    try:
+        get_env_path(session_id)
+    except ValueError as e:
+        raise ToolError(str(e)) from None
+
     return session_id
 
 
 # Register tools
 @mcp.tool()
-def execute_python(
+async def execute_python(
     code: str,
     filename: str = "main.py",
     packages: list[str] | None = None,
@@ -313,11 +976,11 @@ def execute_python(
     The code will be written to the given filename (default main.py) before execution.
     """
 
-    return _execute_python(env_id, code, filename, packages)
+    return await _execute_python(env_id, code, filename, packages)
 
 
 @mcp.tool()
-def write_file(
+async def write_file(
     filename: str,
     content: str,
     env_id: str = Depends(get_session_id),
@@ -325,69 +988,75 @@ def write_file(
     """
     Write a file to the environment.
     """
-    return _write_file(env_id, filename, content)
+    return await _write_file(env_id, filename, content)
 
 
 @mcp.tool()
-def read_file(
+async def read_file(
     filename: str,
     env_id: str = Depends(get_session_id),
 ) -> dict[str, Any] | ImageContent:
     """
     Read a file from the environment. Will be inserted into the context.
     """
-    return _read_file(env_id, filename, annotations=Annotations(audience=["assistant"]))
+    return await _read_file(env_id, filename, annotations=Annotations(audience=["assistant"]))
 
 
 @mcp.tool()
-def present_file(
+async def present_file(
     filename: str,
     env_id: str = Depends(get_session_id),
 ) -> dict[str, Any] | ImageContent:
     """
     Present a file from the environment to the user. Will not be inserted into the context.
     """
-    return _read_file(env_id, filename, annotations=Annotations(audience=["user"]))
+    return await _read_file(env_id, filename, annotations=Annotations(audience=["user"]))
 
 
 @mcp.tool()
-def list_files(
+async def list_files(
     env_id: str = Depends(get_session_id),
 ) -> dict[str, Any]:
     """
     List all files in the environment (excluding virtualenv).
     """
-    return _list_files(env_id)
+    return await _list_files(env_id)
 
 
 @mcp.tool()
-def install_packages(
+async def install_packages(
     packages: list[str],
     env_id: str = Depends(get_session_id),
 ) -> dict[str, Any]:
     """Install packages into the environment."""
-    return _install_packages(env_id, packages)
+    return await _install_packages(env_id, packages)
 
 
 @mcp.tool()
-def remove_packages(
+async def remove_packages(
     packages: list[str],
     env_id: str = Depends(get_session_id),
 ) -> dict[str, Any]:
     """Remove packages from the environment."""
-    return _remove_packages(env_id, packages)
+    return await _remove_packages(env_id, packages)
 
 
 @mcp.tool()
-def list_packages(
+async def list_packages(
     env_id: str = Depends(get_session_id),
 ) -> dict[str, Any]:
     """List all installed packages in the environment."""
-    return _list_packages(env_id)
+    return await _list_packages(env_id)
 
 
 def main():
-    mcp.run()
+    try:
+        import uvloop
+    except ImportError:
+        mcp.run()
+    else:
+        # libuv-backed event loop: cheaper task switches and subprocess/pipe handling
+        asyncio.run(mcp.run_async(), loop_factory=uvloop.new_event_loop)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
+import asyncio
 import shutil
 import subprocess
 from pathlib import Path
+from types import SimpleNamespace
 
 import pytest
 from fastmcp.exceptions import ToolError
@@ -21,6 +23,8 @@ from server import (
     run_uv_command,
 )
 
+pytestmark = pytest.mark.anyio
+
 
 def test_get_env_path_invalid():
     with pytest.raises(ValueError, match="Invalid environment ID"):
@@ -29,6 +33,23 @@ def test_get_env_path_invalid():
         get_env_path("   ")
 
 
+def test_get_env_path_strips_unsafe_characters():
+    assert get_env_path("../my env_1-a") == ENVS_DIR / "myenv_1-a"
+
+
+def test_get_session_id_rejects_invalid_id(monkeypatch):
+    import server
+
+    meta = SimpleNamespace(session_id="../..")
+    ctx = SimpleNamespace(request_context=SimpleNamespace(meta=meta))
+    monkeypatch.setattr(server, "get_context", lambda: ctx)
+    with pytest.raises(ToolError, match="Invalid environment ID"):
+        server.get_session_id()
+
+    meta.session_id = "session-1"
+    assert server.get_session_id() == "session-1"
+
+
 def test_get_safe_file_path_traversal():
     env_path = Path("/tmp/env")
     with pytest.raises(ValueError, match="Illegal filename"):
@@ -37,10 +58,18 @@ def test_get_safe_file_path_traversal():
         get_safe_file_path(env_path, "/etc/passwd")
 
 
-def test_ensure_env_works():
+def test_get_safe_file_path_sibling_prefix(tmp_path):
+    env_path = tmp_path / "env"
+    env_path.mkdir()
+    (tmp_path / "env-other").mkdir()
+    with pytest.raises(ValueError, match="Illegal filename"):
+        get_safe_file_path(env_path, "../env-other/secret.txt")
+
+
+async def test_ensure_env_works():
     env_id = "ensure-env-test"
     try:
-        env_path = _ensure_env(env_id)
+        env_path = await _ensure_env(env_id)
         assert env_path.exists()
         assert (env_path / "pyproject.toml").exists()
     finally:
@@ -48,19 +77,19 @@ def test_ensure_env_works():
             shutil.rmtree(ENVS_DIR / env_id)
 
 
-def test_read_file_not_found():
+async def test_read_file_not_found():
     env_id = "err-env"
-    _ensure_env(env_id)
+    await _ensure_env(env_id)
     try:
         with pytest.raises(ToolError, match="not found"):
-            _read_file(env_id, "ghost.txt", annotations=Annotations(audience=["assistant"]))
+            await _read_file(env_id, "ghost.txt", annotations=Annotations(audience=["assistant"]))
     finally:
         shutil.rmtree(ENVS_DIR / env_id)
 
 
-def test_read_file_too_large():
+async def test_read_file_too_large():
     env_id = "large-env"
-    _ensure_env(env_id)
+    await _ensure_env(env_id)
     try:
         env_path = ENVS_DIR / env_id
         file_path = env_path / "large.bin"
@@ -69,80 +98,108 @@ def test_read_file_too_large():
             f.write(b"\0")
 
         with pytest.raises(ToolError, match="too large"):
-            _read_file(env_id, "large.bin", annotations=Annotations(audience=["assistant"]))
+            await _read_file(env_id, "large.bin", annotations=Annotations(audience=["assistant"]))
     finally:
         shutil.rmtree(ENVS_DIR / env_id)
 
 
-def test_execute_python_no_file():
+async def test_execute_python_no_file():
     env_id = "exec-err-env"
-    _ensure_env(env_id)
+    await _ensure_env(env_id)
     try:
         with pytest.raises(FileNotFoundError, match="not found"):
-            _execute_python(env_id, filename="non-existent.py")
+            await _execute_python(env_id, filename="non-existent.py")
     finally:
         shutil.rmtree(ENVS_DIR / env_id)
 
 
-def test_execute_python_failure():
+async def test_execute_python_failure():
     env_id = "fail-exec-env"
-    _ensure_env(env_id)
+    await _ensure_env(env_id)
     try:
         with pytest.raises(ToolError, match="Execution failed"):
-            _execute_python(env_id, code="import sys; sys.exit(1)")
+            await _execute_python(env_id, code="import sys; sys.exit(1)")
     finally:
         shutil.rmtree(ENVS_DIR / env_id)
 
 
-def test_execute_python_add_package_failure():
+async def test_execute_python_add_package_failure():
     env_id = "pkg-fail-env"
-    _ensure_env(env_id)
+    await _ensure_env(env_id)
     try:
         with pytest.raises(ToolError, match="Failed to add packages"):
-            _execute_python(env_id, code="print(1)", packages=["non-existent-package-name-12345"])
+            await _execute_python(
+                env_id, code="print(1)", packages=["non-existent-package-name-12345"]
+            )
     finally:
         shutil.rmtree(ENVS_DIR / env_id)
 
 
-def test_install_packages_failure():
+async def test_install_packages_failure():
     env_id = "inst-fail-env"
-    _ensure_env(env_id)
+    await _ensure_env(env_id)
     try:
         with pytest.raises(ToolError, match="Error installing packages"):
-            _install_packages(env_id, ["non-existent-package-name-12345"])
+            await _install_packages(env_id, ["non-existent-package-name-12345"])
     finally:
         shutil.rmtree(ENVS_DIR / env_id)
 
 
-def test_remove_packages_failure():
+async def test_remove_packages_failure():
     env_id = "rem-fail-env"
-    _ensure_env(env_id)
+    await _ensure_env(env_id)
     try:
         with pytest.raises(ToolError, match="Error removing packages"):
-            _remove_packages(env_id, ["non-existent-package-name-12345"])
+            await _remove_packages(env_id, ["non-existent-package-name-12345"])
     finally:
         shutil.rmtree(ENVS_DIR / env_id)
 
 
-def test_run_uv_command_timeout(monkeypatch):
-    import subprocess
-
+async def test_run_uv_command_timeout(monkeypatch):
     from server import run_uv_command
 
-    def mock_run(*args, **kwargs):
-        raise subprocess.TimeoutExpired(args[0], 300)
+    async def mock_wait_for(aw, timeout):
+        aw.close()
+        raise TimeoutError
 
-    monkeypatch.setattr(subprocess, "run", mock_run)
-    res = run_uv_command(["version"])
+    monkeypatch.setattr(asyncio, "wait_for", mock_wait_for)
+    res = await run_uv_command(["version"])
     assert res.returncode == 1
+    assert res.args == ["uv", "version"]
     assert "Error: Command timed out" in res.stderr
 
 
-def test_ensure_env_init_failure_mocked(monkeypatch):
+async def test_run_uv_command_cancelled_kills_child(monkeypatch):
+    import server
+    from server import run_uv_command
+
+    procs = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def recording_exec(*args, **kwargs):
+        proc = await create_subprocess_exec(*args, **kwargs)
+        procs.append(proc)
+        return proc
+
+    monkeypatch.setattr(server, "UV_BIN", shutil.which("sleep") or "/bin/sleep")
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", recording_exec)
+    task = asyncio.ensure_future(run_uv_command(["30"]))
+    while not procs:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert procs[0].returncode is not None
+
+
+async def test_ensure_env_init_failure_mocked(monkeypatch, tmp_path):
     import server
     from server import _ensure_env
 
-    def mock_uv_command(args, cwd=None):
+    # Force a template build, which fails along with the direct init fallback
+    monkeypatch.setattr(server, "TEMPLATE_DIR", tmp_path / ".template")
+
+    async def mock_uv_command(args, cwd=None):
         if args[0] == "init":
             return subprocess.CompletedProcess(args, 1, "", "Mock init failure")
         return subprocess.CompletedProcess(args, 0, "", "")
@@ -150,10 +207,10 @@ def test_ensure_env_init_failure_mocked(monkeypatch):
     monkeypatch.setattr(server, "run_uv_command", mock_uv_command)
 
     with pytest.raises(ToolError, match="Failed to initialize"):
-        _ensure_env("mock-fail-env")
+        await _ensure_env("mock-fail-env")
 
 
-def test_read_file_unicode_error_fallback(test_env):
+async def test_read_file_unicode_error_fallback(test_env):
     from server import _read_file
 
     env_path = ENVS_DIR / test_env
@@ -162,76 +219,88 @@ def test_read_file_unicode_error_fallback(test_env):
     with open(file_path, "wb") as f:
         f.write(b"\xe9")  # 'é' in latin-1
 
-    res = _read_file(test_env, "latin1.txt", annotations=Annotations(audience=["assistant"]))
+    res = await _read_file(test_env, "latin1.txt", annotations=Annotations(audience=["assistant"]))
     assert isinstance(res, TextContent)
     assert res.text == "\xe9"
 
+    # Valid UTF-8 around the bad byte still decodes as UTF-8
+    file_path.write_bytes("héllo ".encode() + b"\xff")
+    res = await _read_file(test_env, "latin1.txt", annotations=Annotations(audience=["assistant"]))
+    assert res.text == "héllo \xff"
+
 
-def test_list_packages_parse_error(monkeypatch):
+async def test_list_packages_parse_error(monkeypatch):
     import server
     from server import _ensure_env
 
     env_id = "parse-fail-env"
-    _ensure_env(env_id)
+    env_path = await _ensure_env(env_id)
+    # Without a lockfile the package list comes from uv
+    (env_path / "uv.lock").unlink()
     try:
 
-        def mock_uv_command(args, cwd=None):
+        async def mock_uv_command(args, cwd=None):
             return subprocess.CompletedProcess(args, 0, "not a json", "")
 
         monkeypatch.setattr(server, "run_uv_command", mock_uv_command)
         with pytest.raises(ToolError, match="Failed to parse"):
-            _list_packages(env_id)
+            await _list_packages(env_id)
     finally:
         shutil.rmtree(ENVS_DIR / env_id)
 
 
-def test_list_packages_failure(monkeypatch):
+async def test_list_packages_failure(monkeypatch):
     import server
     from server import _ensure_env
 
     env_id = "list-fail-env"
-    _ensure_env(env_id)
+    env_path = await _ensure_env(env_id)
+    # Without a lockfile the package list comes from uv
+    (env_path / "uv.lock").unlink()
     try:
 
-        def mock_uv_command(args, cwd=None):
+        async def mock_uv_command(args, cwd=None):
             return subprocess.CompletedProcess(args, 1, "", "pip list failed")
 
         monkeypatch.setattr(server, "run_uv_command", mock_uv_command)
         with pytest.raises(ToolError, match="Error listing packages"):
-            _list_packages(env_id)
+            await _list_packages(env_id)
     finally:
         shutil.rmtree(ENVS_DIR / env_id)
 
 
-def test_write_file_exception(monkeypatch):
-    _ensure_env("write-fail-env")
+async def test_write_file_exception(monkeypatch):
+    await _ensure_env("write-fail-env")
     try:
         monkeypatch.setattr("server.get_safe_file_path", lambda x, y: 1 / 0)
         with pytest.raises(ToolError, match="Error writing file"):
-            _write_file("write-fail-env", "test.txt", "data")
+            await _write_file("write-fail-env", "test.txt", "data")
     finally:
         shutil.rmtree(ENVS_DIR / "write-fail-env")
 
 
-def test_read_file_exception(monkeypatch):
+async def test_read_file_exception(monkeypatch):
     from server import _read_file
 
-    _ensure_env("read-fail-env")
+    await _ensure_env("read-fail-env")
     try:
         monkeypatch.setattr("server.get_safe_file_path", lambda x, y: 1 / 0)
         with pytest.raises(ToolError, match="Error reading file"):
-            _read_file("read-fail-env", "test.txt", annotations=Annotations(audience=["assistant"]))
+            await _read_file(
+                "read-fail-env", "test.txt", annotations=Annotations(audience=["assistant"])
+            )
     finally:
         shutil.rmtree(ENVS_DIR / "read-fail-env")
 
 
-def test_run_uv_command_exception(monkeypatch):
-    def mock_run(*args, **kwargs):
+async def test_run_uv_command_exception(monkeypatch):
+    async def mock_exec(*args, **kwargs):
         raise Exception("Mock error")
 
-    monkeypatch.setattr(subprocess, "run", mock_run)
-    res = run_uv_command(["version"])
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_exec)
+    res = await run_uv_command(["version"])
     assert res.returncode == 1
+    assert res.args == ["uv", "version"]
     assert "Error: Mock error" in res.stderr
 
 
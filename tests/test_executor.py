@@ -1,7 +1,19 @@
+import asyncio
 import base64
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
 
-from fastmcp.utilities.types import File, Image
-from mcp.types import Annotations, TextContent
+import pytest
+from mcp.types import (
+    Annotations,
+    BlobResourceContents,
+    EmbeddedResource,
+    ImageContent,
+    TextContent,
+)
 
 from server import (
     BASE_PACKAGES,
@@ -11,36 +23,45 @@ from server import (
     _install_packages,
     _list_files,
     _list_packages,
+    _load_locked_packages,
     _read_file,
     _remove_packages,
     _write_file,
+    run_uv_package_command,
 )
 
+pytestmark = pytest.mark.anyio
+
 
-def test_write_and_read_file(test_env):
+async def test_write_and_read_file(test_env):
     filename = "test.txt"
     content = "hello pytest"
-    res = _write_file(test_env, filename, content)
+    res = await _write_file(test_env, filename, content)
     assert res["status"] == "success"
 
-    read_res = _read_file(test_env, filename, annotations=Annotations(audience=["assistant"]))
+    read_res = await _read_file(test_env, filename, annotations=Annotations(audience=["assistant"]))
     assert isinstance(read_res, TextContent)
     assert read_res.text == content
 
 
-def test_list_packages(test_env):
+async def test_list_packages(test_env):
     # Should have no external packages initially (besides stdlib and boilerplate)
-    res = _list_packages(test_env)
+    res = await _list_packages(test_env)
     assert isinstance(res, dict)
     assert "packages" in res
     assert isinstance(res["packages"], list)
+    names = {p["name"] for p in res["packages"]}
+    assert "numpy" in names
+    # Locked for other platforms only, so never installed here
+    if sys.platform != "win32":
+        assert "tzdata" not in names
 
 
-def test_list_files(test_env):
-    _write_file(test_env, "a.txt", "a")
-    _write_file(test_env, "sub/b.txt", "b")
+async def test_list_files(test_env):
+    await _write_file(test_env, "a.txt", "a")
+    await _write_file(test_env, "sub/b.txt", "b")
 
-    res = _list_files(test_env)
+    res = await _list_files(test_env)
     files = res["files"]
     assert "a.txt" in files
     assert "sub/b.txt" in files
@@ -48,30 +69,43 @@ def test_list_files(test_env):
     assert files.index("a.txt") < files.index("sub/b.txt")
 
 
-def test_execute_python(test_env):
+async def test_execute_python(test_env):
     code = "print('hello from python')"
-    res = _execute_python(test_env, code=code)
+    res = await _execute_python(test_env, code=code)
     assert "hello from python" in res["stdout"]
 
 
-def test_execute_with_packages(test_env):
+async def test_execute_python_non_utf8_output(test_env):
+    res = await _execute_python(test_env, code="import sys; sys.stdout.buffer.write(b'ok\\xff')")
+    assert res["stdout"] == "ok\ufffd"
+
+
+async def test_execute_python_output_is_capped(test_env, monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "MAX_OUTPUT_SIZE", 1000)
+    res = await _execute_python(test_env, code="print('x' * 5000)")
+    assert res["stdout"].startswith("x" * 1000 + "\n[output truncated: 4001 more bytes]")
+
+
+async def test_execute_with_packages(test_env):
     # This might be slow as it installs a package
     code = "import requests; print(requests.__version__)"
-    res = _execute_python(test_env, code=code, packages=["requests"])
+    res = await _execute_python(test_env, code=code, packages=["requests"])
     assert "2." in res["stdout"]  # Assuming a 2.x version of requests
 
 
-def test_install_and_remove_packages(test_env):
-    res = _install_packages(test_env, ["beartype"])
+async def test_install_and_remove_packages(test_env):
+    res = await _install_packages(test_env, ["beartype"])
     assert res["status"] == "success"
     assert "beartype" in res["installed"]
 
-    res = _remove_packages(test_env, ["beartype"])
+    res = await _remove_packages(test_env, ["beartype"])
     assert res["status"] == "success"
     assert "beartype" in res["removed"]
 
 
-def test_image_detection(test_env):
+async def test_image_detection(test_env):
     # Create a tiny 1x1 transparent PNG
     png_data = base64.b64decode(
         "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8/5+hHgAHggJ/PchI7wAAAABJRU5ErkJggg=="
@@ -80,26 +114,39 @@ def test_image_detection(test_env):
     with open(env_path / "test.png", "wb") as f:
         f.write(png_data)
 
-    res = _read_file(test_env, "test.png", annotations=Annotations(audience=["assistant"]))
-    assert isinstance(res, Image)
+    res = await _read_file(test_env, "test.png", annotations=Annotations(audience=["assistant"]))
+    assert isinstance(res, ImageContent)
+    assert res.mimeType == "image/png"
+    assert base64.b64decode(res.data) == png_data
+
+    # Recognized by its magic bytes even without an image extension
+    with open(env_path / "plot.dat", "wb") as f:
+        f.write(png_data)
+    res = await _read_file(test_env, "plot.dat", annotations=Annotations(audience=["assistant"]))
+    assert isinstance(res, ImageContent)
+    assert res.mimeType == "image/png"
 
 
-def test_binary_detection(test_env):
+async def test_binary_detection(test_env):
     env_path = ENVS_DIR / test_env
+    # Large enough to be encoded in several chunks
+    data = b"\x00\x01\x02\x03" * 500_000
     with open(env_path / "test.bin", "wb") as f:
-        f.write(b"\x00\x01\x02\x03")
+        f.write(data)
 
-    res = _read_file(test_env, "test.bin", annotations=Annotations(audience=["assistant"]))
-    assert isinstance(res, File)
+    res = await _read_file(test_env, "test.bin", annotations=Annotations(audience=["assistant"]))
+    assert isinstance(res, EmbeddedResource)
+    assert isinstance(res.resource, BlobResourceContents)
+    assert base64.b64decode(res.resource.blob) == data
 
 
-def test_lazy_initialization():
+async def test_lazy_initialization():
     env_id = "lazy-env"
     # Ensure it's clean
     if (ENVS_DIR / env_id).exists():
         _delete_env(env_id)
 
-    res = _execute_python(env_id, code="print('lazy')")
+    res = await _execute_python(env_id, code="print('lazy')")
     assert "lazy" in res["stdout"]
     assert (ENVS_DIR / env_id).exists()
 
@@ -107,9 +154,9 @@ def test_lazy_initialization():
     _delete_env(env_id)
 
 
-def test_base_packages_installed(test_env):
+async def test_base_packages_installed(test_env):
     """Test that base packages are preinstalled in new environments."""
-    res = _list_packages(test_env)
+    res = await _list_packages(test_env)
     package_names = [pkg["name"] for pkg in res["packages"]]
     for base_pkg in BASE_PACKAGES:
         # Handle optional dependencies like plotly[express]
@@ -117,3 +164,317 @@ def test_base_packages_installed(test_env):
         assert pkg_name in package_names, (
             f"Base package {pkg_name} not found in environment {test_env}"
         )
+
+
+async def test_package_commands_are_coalesced(monkeypatch, tmp_path):
+    import server
+
+    calls = []
+
+    async def mock_uv_command(args, cwd=None):
+        calls.append(args)
+        return subprocess.CompletedProcess(args, 0, "", "")
+
+    monkeypatch.setattr(server, "run_uv_command", mock_uv_command)
+    results = await asyncio.gather(
+        run_uv_package_command("add", ["numpy", "scipy"], cwd=tmp_path),
+        run_uv_package_command("add", ["scipy", "sympy"], cwd=tmp_path),
+    )
+    assert calls == [["add", "numpy", "scipy", "sympy"]]
+    assert all(res.returncode == 0 for res in results)
+
+
+async def test_package_batch_errors_reach_callers(monkeypatch, tmp_path):
+    import server
+
+    async def mock_uv_command(args, cwd=None):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(server, "run_uv_command", mock_uv_command)
+    results = await asyncio.gather(
+        run_uv_package_command("add", ["numpy"], cwd=tmp_path),
+        run_uv_package_command("add", ["scipy"], cwd=tmp_path),
+        return_exceptions=True,
+    )
+    assert all(isinstance(res, RuntimeError) for res in results)
+
+
+async def test_add_skips_existing_dependencies(monkeypatch, tmp_path):
+    import server
+
+    calls = []
+
+    async def mock_uv_command(args, cwd=None):
+        calls.append(args)
+        return subprocess.CompletedProcess(args, 0, "", "")
+
+    monkeypatch.setattr(server, "run_uv_command", mock_uv_command)
+    (tmp_path / "pyproject.toml").write_text(
+        '[project]\nname = "x"\ndependencies = ["numpy>=2.3.0", "Foo_Bar"]\n'
+    )
+
+    res = await run_uv_package_command("add", ["numpy", "foo-bar"], cwd=tmp_path)
+    assert res.returncode == 0
+    assert calls == []
+
+    await run_uv_package_command("add", ["numpy", "numpy<2", "scipy"], cwd=tmp_path)
+    assert calls == [["add", "numpy<2", "scipy"]]
+
+    # An undecodable pyproject.toml leaves the decision to uv
+    (tmp_path / "pyproject.toml").write_bytes(b'[project]\nname = "\xff"\n')
+    await run_uv_package_command("add", ["numpy"], cwd=tmp_path)
+    assert calls[-1] == ["add", "numpy"]
+
+
+def test_load_locked_packages(tmp_path):
+    lock_path = tmp_path / "uv.lock"
+    lock_path.write_text(
+        'version = 1\n\n[[package]]\nname = "numpy"\nversion = "2.3.0"\n\n'
+        '[[package]]\nname = "pytest-env"\nversion = "0.1.0"\nsource = { editable = "." }\n'
+    )
+    packages = _load_locked_packages(lock_path, lock_path.stat().st_mtime_ns)
+    assert packages == [
+        {"name": "numpy", "version": "2.3.0"},
+        {"name": "pytest-env", "version": "0.1.0"},
+    ]
+
+
+async def test_ensure_env_is_cached(test_env, monkeypatch):
+    import server
+
+    env_path = await server._ensure_env(test_env)
+    assert server._ENV_PATHS[test_env] == env_path
+
+    monkeypatch.setattr(server, "get_env_path", lambda env_id: 1 / 0)
+    assert await server._ensure_env(test_env) == env_path
+
+    monkeypatch.undo()
+    _delete_env(test_env)
+    assert test_env not in server._ENV_PATHS
+
+
+async def test_list_files_skips_tooling_dirs(test_env):
+    await _write_file(test_env, "pkg/__pycache__/mod.cpython-314.pyc", "x")
+    await _write_file(test_env, "pkg/mod.py", "x")
+
+    files = (await _list_files(test_env))["files"]
+    assert "pkg/mod.py" in files
+    assert not any(f.startswith((".venv/", ".git/")) or "__pycache__" in f for f in files)
+
+
+async def test_large_binary_reread_after_write(test_env):
+    first = b"\x00" * (1024 * 1024)
+    (ENVS_DIR / test_env / "blob.bin").write_bytes(first)
+    res = await _read_file(test_env, "blob.bin", annotations=Annotations(audience=["user"]))
+    assert base64.b64decode(res.resource.blob) == first
+
+    await _write_file(test_env, "blob.bin", "\x00" * (1024 * 1024 - 1) + "\x01")
+    res = await _read_file(test_env, "blob.bin", annotations=Annotations(audience=["user"]))
+    assert base64.b64decode(res.resource.blob).endswith(b"\x01")
+
+
+async def test_env_cloned_from_template(test_env):
+    from server import TEMPLATE_DIR, _list_envs
+
+    assert TEMPLATE_DIR.exists()
+    assert (ENVS_DIR / test_env / ".venv").exists()
+    assert TEMPLATE_DIR.name not in _list_envs()["environments"]
+
+    # The clone's editable install points at its own sources, not the template build dir
+    pth_files = list((ENVS_DIR / test_env / ".venv").glob("lib/*/site-packages/*mcp_env*.pth"))
+    assert pth_files
+    assert str(ENVS_DIR / test_env / "src") in pth_files[0].read_text()
+
+
+async def test_template_rebuilt_when_base_packages_change(monkeypatch, tmp_path):
+    import server
+
+    calls = []
+
+    async def mock_uv_command(args, cwd: Path):
+        calls.append(args)
+        (cwd / "pyproject.toml").write_text(repr(args))
+        return subprocess.CompletedProcess(args, 0, "", "")
+
+    monkeypatch.setattr(server, "TEMPLATE_DIR", tmp_path / "envs" / ".template")
+    monkeypatch.setattr(server, "TRASH_DIR", tmp_path)
+    monkeypatch.setattr(server, "run_uv_command", mock_uv_command)
+
+    assert await server._ensure_template()
+    assert await server._ensure_template()
+    assert len(calls) == 2
+
+    monkeypatch.setattr(server, "BASE_PACKAGES", ["numpy"])
+    assert await server._ensure_template()
+    assert calls[-1] == ["add", "--no-sync", "numpy"]
+    assert not list((tmp_path / "envs").glob(".template-*"))
+
+
+async def test_template_build_loses_rename_race(monkeypatch, tmp_path):
+    import server
+
+    template_dir = tmp_path / ".template"
+
+    async def mock_uv_command(args, cwd=None):
+        if args[0] == "add":
+            # Another server process finishes its template build first
+            template_dir.mkdir()
+            (template_dir / "pyproject.toml").write_text("")
+            (template_dir / server.TEMPLATE_STAMP_FILE).write_text(server._template_stamp())
+        return subprocess.CompletedProcess(args, 0, "", "")
+
+    monkeypatch.setattr(server, "TEMPLATE_DIR", template_dir)
+    monkeypatch.setattr(server, "run_uv_command", mock_uv_command)
+
+    assert await server._ensure_template()
+    assert not list(tmp_path.glob(".template-*"))
+
+
+async def test_clone_keeps_env_when_sync_fails(monkeypatch, tmp_path, capsys):
+    import server
+
+    template_dir = tmp_path / "envs" / ".template"
+    template_dir.mkdir(parents=True)
+    (template_dir / "pyproject.toml").write_text("")
+    (template_dir / server.TEMPLATE_STAMP_FILE).write_text(server._template_stamp())
+
+    async def mock_uv_command(args, cwd=None):
+        return subprocess.CompletedProcess(args, 1, "", "Mock sync failure")
+
+    monkeypatch.setattr(server, "TEMPLATE_DIR", template_dir)
+    monkeypatch.setattr(server, "run_uv_command", mock_uv_command)
+
+    env_path = tmp_path / "envs" / "env"
+    await server._clone_template("env", env_path)
+    assert (env_path / "pyproject.toml").exists()
+    assert "Mock sync failure" in capsys.readouterr().err
+
+
+async def test_list_envs_resource_sees_same_tick_changes(test_env):
+    import server
+
+    assert test_env in server._render_envs_list()
+    # A deletion landing in the same timestamp tick as the last render
+    st = ENVS_DIR.stat()
+    _delete_env(test_env)
+    os.utime(ENVS_DIR, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert test_env not in server._render_envs_list()
+
+
+async def test_list_envs_detailed(test_env):
+    from server import _list_envs_detailed
+
+    res = await _list_envs_detailed()
+    by_id = {env["env_id"]: env for env in res["environments"]}
+    assert "packages" in by_id[test_env]
+
+
+async def test_write_file_counts_bytes(test_env):
+    res = await _write_file(test_env, "unicode.txt", "héllo")
+    assert res["bytes_written"] == 6
+    assert (ENVS_DIR / test_env / "unicode.txt").read_text(encoding="utf-8") == "héllo"
+
+
+async def test_execute_python_skips_sync_when_unchanged(test_env, monkeypatch):
+    import server
+
+    calls = []
+    real_run_uv_command = server.run_uv_command
+
+    async def spy(args, cwd=None):
+        calls.append(args)
+        return await real_run_uv_command(args, cwd=cwd)
+
+    monkeypatch.setattr(server, "run_uv_command", spy)
+    await _execute_python(test_env, code="print(1)")
+    res = await _execute_python(test_env, code="print(2)")
+    assert res["stdout"].strip() == "2"
+    assert "--no-sync" in calls[-1]
+
+    await _install_packages(test_env, ["six"])
+    await _execute_python(test_env, code="import six")
+    assert "--no-sync" not in calls[-1]
+
+
+async def test_delete_env_frees_id_immediately(test_env):
+    from server import _list_envs
+
+    _delete_env(test_env)
+    assert not (ENVS_DIR / test_env).exists()
+    assert test_env not in _list_envs()["environments"]
+    assert not [name for name in os.listdir(ENVS_DIR) if test_env in name]
+
+
+async def test_concurrent_ensure_env_creates_once():
+    from server import _ensure_env
+
+    env_id = "concurrent-env"
+    try:
+        paths = await asyncio.gather(*(_ensure_env(env_id) for _ in range(3)))
+        assert len(set(paths)) == 1
+        assert not (paths[0] / ".template").exists()
+    finally:
+        _delete_env(env_id)
+
+
+async def test_write_file_leaves_no_temp_files(test_env):
+    await _write_file(test_env, "data.txt", "first")
+    await _write_file(test_env, "data.txt", "second")
+
+    assert (ENVS_DIR / test_env / "data.txt").read_text() == "second"
+    assert not [f for f in (await _list_files(test_env))["files"] if f.endswith(".tmp")]
+
+
+async def test_read_file_larger_than_head(test_env):
+    content = "line\n" * 50_000
+    await _write_file(test_env, "log.txt", content)
+    res = await _read_file(test_env, "log.txt", annotations=Annotations(audience=["user"]))
+    assert isinstance(res, TextContent)
+    assert res.text == content
+
+
+async def test_write_file_keeps_mode(test_env):
+    script = ENVS_DIR / test_env / "run.sh"
+    script.write_text("echo one\n")
+    script.chmod(0o755)
+
+    await _write_file(test_env, "run.sh", "echo two\n")
+    assert script.stat().st_mode & 0o7777 == 0o755
+    assert script.read_text() == "echo two\n"
+
+
+async def test_write_file_recreates_env_deleted_on_disk(test_env):
+    env_path = ENVS_DIR / test_env
+    shutil.rmtree(env_path)
+
+    await _write_file(test_env, "x.txt", "data")
+    assert (env_path / "x.txt").read_text() == "data"
+    assert (env_path / "pyproject.toml").exists()
+
+
+def test_optional_speedups_used_when_installed():
+    msgspec = pytest.importorskip("msgspec")
+    pybase64 = pytest.importorskip("pybase64")
+    import server
+
+    assert server._json_loads is msgspec.json.decode
+    assert server._b64encode is pybase64.b64encode
+    assert server._json_loads(server._json_dumps({"a": [1, "é"]})) == {"a": [1, "é"]}
+    assert server._b64encode_str(b"\x00\xff") == base64.b64encode(b"\x00\xff").decode()
+
+
+def test_optional_speedups_fall_back_to_stdlib():
+    script = """
+import base64, json, sys
+sys.modules["msgspec"] = sys.modules["pybase64"] = None
+import server
+assert server._json_loads is json.loads
+assert server._b64encode is base64.b64encode
+assert server._json_loads(server._json_dumps({"a": [1, "é"]})) == {"a": [1, "é"]}
+assert server._b64encode_str(b"\\x00\\xff") == "AP8="
+"""
+    subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=Path(__file__).parent.parent,
+        check=True,
+    )